@@ -2,22 +2,31 @@
 Classes and functions for explaining the clusters using LLMs.
 """
 
-from transformers import LlavaNextProcessor, LlavaNextForConditionalGeneration
+from transformers import LlavaNextProcessor, LlavaNextForConditionalGeneration, BitsAndBytesConfig
+from transformers import StoppingCriteria, StoppingCriteriaList
+from torch.nn.attention import SDPBackend, sdpa_kernel
 from metrics import CaptionEmbeddingDistance
-from finetuneCLIP import load_model
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
+from packaging import version
 from PIL import Image
 import numpy as np
 import warnings
-import pickle
+import tempfile
+import hashlib
+import json
+import transformers
 import clip
 import torch
+import os
 
 # General settings
 warnings.filterwarnings("ignore", category=FutureWarning)
 
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
+dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
 
 
 
@@ -32,36 +41,164 @@ Avoid general information and focus only on the most relevant aspects of the art
 """
 
 
+class StopOnTokens(StoppingCriteria):
+
+    def __init__(self, stop_ids: List[int]) -> None:
+        """Initializes the stopping criteria.
+
+        Args:
+            stop_ids (List[int]): The token ids on which to stop the generation.
+        """
+        super().__init__()
+        self._stop_ids = torch.tensor(stop_ids)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        """Checks whether each sequence has just generated a stop token.
+
+        Args:
+            input_ids (torch.LongTensor): The generated sequences so far.
+            scores (torch.FloatTensor): The prediction scores.
+
+        Returns:
+            torch.BoolTensor: Whether each sequence is done.
+        """
+        # Moving the ids only once, on the first decoding step
+        if self._stop_ids.device != input_ids.device:
+            self._stop_ids = self._stop_ids.to(input_ids.device)
+        return torch.isin(input_ids[:, -1], self._stop_ids)
+
+
 class Explainer:
 
     def __init__(self,
                  embedding_model: Tuple[str, str] = ("ViT-B/32", "models/finetuned-v2.pt"),
-                 pov_names: List[str] = ["Genre", "Subject", "Medium", "Style"]) -> None:
+                 pov_names: List[str] = ["Genre", "Subject", "Medium", "Style"],
+                 backend: str = "hf",
+                 batch_size: int = 10,
+                 max_prompt_length: int = 3584) -> None:
         """Initializes the explainer.
 
         Args:
             embedding_model (Tuple[str, str]): The embedding model to use. Defaults to ("ViT-B/32", "models/finetuned-v2.pt").
             pov_names (List[str]): The pov names. Defaults to ["Genre", "Subject", "Medium", "Style"].
+            backend (str): The LLM backend to use, either "hf" or "vllm". Defaults to "hf".
+            batch_size (int): The maximum batch size of the hf generation, also the one it is warmed up with. Defaults to 10.
+            max_prompt_length (int): The maximum prompt length (image tokens included) of the hf generation. Defaults to 3584.
         """
-        self._embedding_model = load_model(embedding_model[0], embedding_model[1])
         self._pov_names = pov_names
         self._topics = []
-
-        # Setting up LLM & processor
-        self._llm = LlavaNextForConditionalGeneration.from_pretrained(
-            "llava-hf/llava-v1.6-mistral-7b-hf",
-            torch_dtype=torch.float16,
-            device_map="auto"
+        # Precompiling the rich prompt with a placeholder for each pov
+        self._rich_template = RICH_PROMPT + "\n".join(
+            f"{pov_name.upper()} : {{{i}}}"
+            for i, pov_name in enumerate(pov_names)
         )
-        self._llm.config.pad_token_id = self._llm.config.eos_token_id
-        
+        self._backend = backend.lower()
+        if self._backend != "vllm":
+            self._check_processor()
+        # Per-instance cache of the templated prompts
+        self._templated = lru_cache(maxsize=64)(self._apply_template)
+        self._pix_cache_dir = "results/_pixcache/"
+        self._batch_size = batch_size
+        self._max_prompt_length = max_prompt_length
+
+        # Loading the embedding model (through the CED metric) and the LLM one after the other,
+        # since quantized loading patches torch globally and vLLM must own the main thread
+        self._metric = CaptionEmbeddingDistance(embedding_model)
+        self._llm = self._load_llm()
+
+        if self._backend == "vllm":
+            from vllm import SamplingParams
+            self._sampling_params = SamplingParams(max_tokens=60, temperature=.0, stop=["."], include_stop_str_in_output=True)
+
         self._processor = LlavaNextProcessor.from_pretrained(
             "llava-hf/llava-v1.6-mistral-7b-hf",
             vision_feature_select_strategy="default",
             patch_size=14
         )
+        self._tokenizer = self._processor.tokenizer
+        self._tokenizer.padding_side = "left"
+        self._image_processor = self._processor.image_processor
+        # Tagging the cached pixel values with the image processor configuration
+        image_processor_config = json.dumps(self._image_processor.to_dict(), sort_keys=True, default=str)
+        self._pix_cache_tag = hashlib.md5(image_processor_config.encode()).hexdigest()
+        # Stopping the generation at the end of the first sentence
+        self._stop = StoppingCriteriaList([
+            StopOnTokens([self._tokenizer.convert_tokens_to_ids(".")])
+        ])
+        # Compiling the language model and paying the compilation upfront
+        if self._backend != "vllm":
+            # The language model lives under the inner model since transformers 4.52
+            owner = getattr(self._llm, "model", self._llm)
+            owner.language_model = torch.compile(owner.language_model, mode="reduce-overhead", fullgraph=False)
+            # Static KV cache so that every decoding step has the same shapes for the CUDA graphs,
+            # the prompts being padded to a few bucketed lengths in _generate_hf
+            self._llm.generation_config.cache_implementation = "static"
+            # Channels last patch embedding for the tensor cores
+            self._llm.vision_tower.to(memory_format=torch.channels_last)
+            self._warmup()
 
 
+    def _load_llm(self) -> Any:
+        """Loads the LLM according to the backend.
+
+        Returns:
+            Any: The loaded LLM.
+        """
+        if self._backend == "vllm":
+            from vllm import LLM
+            return LLM(
+                model="llava-hf/llava-v1.6-mistral-7b-hf",
+                dtype=dtype,
+                quantization="fp8",
+                max_model_len=4096,
+                gpu_memory_utilization=.9,
+                enable_prefix_caching=True
+            )
+
+        # Loading the weights as 4-bit NF4
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=dtype,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True
+        )
+        llm = LlavaNextForConditionalGeneration.from_pretrained(
+            "llava-hf/llava-v1.6-mistral-7b-hf",
+            quantization_config=quantization_config,
+            torch_dtype=dtype,
+            attn_implementation="sdpa",
+            device_map={"": 0}
+        )
+        llm.config.pad_token_id = llm.config.eos_token_id
+        return llm
+
+    def _check_processor(self) -> None:
+        """Checks that the processor expands the image token as _expand_image_token replicates it.
+
+        The check only looks at the installed transformers, so that it fails before loading any weights.
+
+        Returns:
+            None
+        """
+        if (version.parse(transformers.__version__) < version.parse("4.45.0")
+                or not hasattr(LlavaNextProcessor, "_get_number_of_features")):
+            raise ImportError(
+                "The hf backend requires transformers>=4.45, where the LlavaNext processor expands the image token."
+            )
+
+    def _warmup(self) -> None:
+        """Runs a dummy generation so that the first actual call does not pay the compilation time.
+
+        The warmup runs a full batch, so that it matches the shape of a run with as many clusters as the batch size.
+        Other batch sizes and prompt length buckets pay a new CUDA graph the first time they are seen.
+
+        Returns:
+            None
+        """
+        prompt = self._templated("Describe the image.")
+        pixels = dict(self._image_processor(Image.new("RGB", (336, 336)), return_tensors="pt"))
+        self._generate_hf([pixels] * self._batch_size, [prompt] * self._batch_size)
+
     def __call__(self,
                  saving_path: str,
                  image_paths: List[str],
@@ -70,7 +207,7 @@ class Explainer:
         """Explains the topics using the LLM.
 
         Args:
-            saving_path (str): The path to save the results.
+            saving_path (str): The path to the json file where to save the results.
             image_paths (List[str]): The paths to the topic images.
             topics (List[List[str]]): The topics to explain.
             rich_prompt (bool, optional): Whether to use a comprehensive prompt_text. Defaults to False.
@@ -81,15 +218,15 @@ class Explainer:
         self._topics = topics
         # Setting up the prompts and generating the descriptions
         prompts = [self._setup_prompt(topic, rich_prompt) for topic in self._topics]
-        descriptions = [
-            self.describe(image_path, prompt_text)
-            for image_path, prompt_text in zip(image_paths, prompts)
-        ]
+        descriptions = self.describe_batch(image_paths, prompts)
+        # Returning the unused allocator blocks before scoring, the static KV cache is kept
+        # on the model on purpose since the CUDA graphs of the compiled decoder point to it
+        if device == "cuda":
+            torch.cuda.empty_cache()
 
-        metric = CaptionEmbeddingDistance()
-        saving = {"descriptions": descriptions, "CED": metric(descriptions)}
-        with open(saving_path, "wb") as f:
-            pickle.dump(saving, f)
+        saving = {"descriptions": descriptions, "CED": self._metric(descriptions)}
+        with open(saving_path, "w") as f:
+            json.dump(saving, f, indent=4)
 
     def _setup_prompt(self, topic: List[List[str]], rich_prompt: bool) -> str:
         """Sets up the prompt text.
@@ -101,17 +238,11 @@ class Explainer:
         Returns:
             str: The prompt text.
         """
-        prompt_text = BASIC_PROMPT
+        if not rich_prompt:
+            return BASIC_PROMPT
 
-        if rich_prompt:
-            prompt_text = RICH_PROMPT
-            povs = np.array_split(topic, len(self._pov_names))
-            extra_content = "\n".join(
-                f"{pov_name.upper()} : " + ", ".join(povs[i])
-                for i, pov_name in enumerate(self._pov_names)
-            )
-            prompt_text += extra_content
-        return prompt_text
+        povs = np.array_split(topic, len(self._pov_names))
+        return self._rich_template.format(*(", ".join(pov) for pov in povs))
 
     def describe(self, image_path: str, prompt_text: str) -> str:
         """Describe the topic given a sample image using the LLM.
@@ -123,7 +254,46 @@ class Explainer:
         Returns:
             str: The description.
         """
-        image = Image.open(image_path).convert("RGB")
+        return self.describe_batch([image_path], [prompt_text])[0]
+
+    def describe_batch(self, image_paths: List[str], prompts: List[str]) -> List[str]:
+        """Describe the topics given their sample images using the LLM, batching the generation.
+
+        Args:
+            image_paths (List[str]): The paths to the sample images.
+            prompts (List[str]): The prompt texts to use.
+
+        Returns:
+            List[str]: The descriptions.
+        """
+        # Preparing the prompts
+        prompts = [self._templated(prompt_text) for prompt_text in prompts]
+        # Loading the images in parallel
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            if self._backend == "vllm":
+                images = list(executor.map(lambda path: Image.open(path).convert("RGB"), image_paths))
+            else:
+                pixels = list(executor.map(self._pixel_values, image_paths))
+        # Actual generation
+        if self._backend == "vllm":
+            descriptions = self._generate_vllm(images, prompts)
+        else:
+            descriptions = self._generate_hf(pixels, prompts)
+
+        descriptions = [str(description).strip() for description in descriptions]
+        for description in descriptions:
+            print(f"Description: {description}")
+        return descriptions
+
+    def _apply_template(self, prompt_text: str) -> str:
+        """Applies the chat template to the prompt text.
+
+        Args:
+            prompt_text (str): The prompt text.
+
+        Returns:
+            str: The templated prompt.
+        """
         conversation = [
             {
                 "role": "user",
@@ -133,17 +303,130 @@ class Explainer:
                 ],
             },
         ]
-        # Preparing the prompt
-        prompt = self._processor.apply_chat_template(
-            conversation=conversation,
-            add_generation_prompt=True
+        return self._processor.apply_chat_template(conversation=conversation, add_generation_prompt=True)
+
+    def _pixel_values(self, image_path: str) -> Dict[str, torch.Tensor]:
+        """Loads the processed image from the disk cache, processing and caching it if missing.
+
+        Args:
+            image_path (str): The path to the image.
+
+        Returns:
+            Dict[str, torch.Tensor]: The pixel values and the image sizes.
+        """
+        key = f"{image_path}:{os.path.getmtime(image_path)}:{self._pix_cache_tag}"
+        key = hashlib.md5(key.encode()).hexdigest()
+        cache_path = os.path.join(self._pix_cache_dir, f"{key}.pt")
+        if os.path.exists(cache_path):
+            return torch.load(cache_path)
+
+        image = Image.open(image_path).convert("RGB")
+        pixels = dict(self._image_processor(image, return_tensors="pt"))
+        # Writing to a temporary file first so that the cache never holds a partial file
+        os.makedirs(self._pix_cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self._pix_cache_dir, suffix=".tmp")
+        os.close(fd)
+        torch.save(pixels, tmp_path)
+        os.replace(tmp_path, cache_path)
+        return pixels
+
+    def _expand_image_token(self, prompt: str, pixels: Dict[str, torch.Tensor]) -> str:
+        """Expands the image token of the prompt into as many tokens as the image features.
+
+        Args:
+            prompt (str): The templated prompt.
+            pixels (Dict[str, torch.Tensor]): The pixel values and the image sizes.
+
+        Returns:
+            str: The expanded prompt.
+        """
+        height, width = pixels["pixel_values"].shape[-2:]
+        orig_height, orig_width = pixels["image_sizes"][0].tolist()
+        num_image_tokens = self._processor._get_number_of_features(orig_height, orig_width, height, width)
+        if self._processor.vision_feature_select_strategy == "default":
+            num_image_tokens -= 1
+        image_token = self._processor.image_token
+        return prompt.replace(image_token, image_token * num_image_tokens, 1)
+
+    def _generate_hf(self, pixels: List[Dict[str, torch.Tensor]], prompts: List[str]) -> List[str]:
+        """Generates the descriptions with batched HuggingFace generate calls.
+
+        The prompts are split in batches of at most the batch size, and each batch is padded to
+        its longest prompt rounded up to a multiple of 512 tokens, so that the static cache and
+        the compiled decoder only see a few shapes.
+
+        Args:
+            pixels (List[Dict[str, torch.Tensor]]): The pixel values and the image sizes of the sample images.
+            prompts (List[str]): The templated prompts.
+
+        Returns:
+            List[str]: The generated texts.
+        """
+        prompts = [self._expand_image_token(prompt, pix) for prompt, pix in zip(prompts, pixels)]
+        input_ids = self._tokenizer(prompts)["input_ids"]
+        # Checking all the prompts upfront so that no batch is generated in vain
+        longest = max(len(ids) for ids in input_ids)
+        if longest > self._max_prompt_length:
+            raise ValueError(f"Prompts are longer ({longest}) than max_prompt_length ({self._max_prompt_length}).")
+
+        descriptions = []
+        for start in range(0, len(prompts), self._batch_size):
+            batch_ids = input_ids[start:start + self._batch_size]
+            length = -(-max(len(ids) for ids in batch_ids) // 512) * 512
+            length = min(length, self._max_prompt_length)
+            descriptions += self._generate_hf_batch(pixels[start:start + self._batch_size], batch_ids, length)
+        return descriptions
+
+    def _generate_hf_batch(self, pixels: List[Dict[str, torch.Tensor]], input_ids: List[List[int]], length: int) -> List[str]:
+        """Generates the descriptions of a single batch.
+
+        Args:
+            pixels (List[Dict[str, torch.Tensor]]): The pixel values and the image sizes of the sample images.
+            input_ids (List[List[int]]): The tokenized expanded prompts.
+            length (int): The length to pad the prompts to.
+
+        Returns:
+            List[str]: The generated texts.
+        """
+        inputs = self._tokenizer.pad({"input_ids": input_ids}, padding="max_length", max_length=length, return_tensors="pt")
+        inputs = inputs.to(device)
+        # Padding the image patches to the largest number in the batch
+        max_patches = max(pix["pixel_values"].shape[1] for pix in pixels)
+        pixel_values = torch.zeros(len(pixels), max_patches, *pixels[0]["pixel_values"].shape[2:])
+        for i, pix in enumerate(pixels):
+            pixel_values[i, :pix["pixel_values"].shape[1]] = pix["pixel_values"][0]
+        inputs["pixel_values"] = pixel_values.to(device, dtype)
+        inputs["image_sizes"] = torch.cat([pix["image_sizes"] for pix in pixels]).to(device)
+
+        with torch.no_grad(), sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]):
+            output_ids = self._llm.generate(
+                **inputs,
+                max_new_tokens=60,
+                do_sample=False,
+                use_cache=True,
+                stopping_criteria=self._stop,
+                eos_token_id=self._tokenizer.eos_token_id,
+                pad_token_id=self._tokenizer.pad_token_id or self._tokenizer.eos_token_id
+            )
+        # Decoding only the generated tokens
+        return self._tokenizer.batch_decode(
+            output_ids[:, inputs.input_ids.shape[1]:],
+            skip_special_tokens=True
         )
-        input_ids = self._processor(image, prompt, return_tensors="pt").to(device)
-        # Actual generation
-        with torch.no_grad():
-            output_ids = self._llm.generate(**input_ids, max_new_tokens=100)
-        description = self._processor.decode(output_ids[0], skip_special_tokens=True)
 
-        description = str(description).split("[/INST]")[-1].strip()
-        print(f"Description: {description}")
-        return description
+    def _generate_vllm(self, images: List[Image.Image], prompts: List[str]) -> List[str]:
+        """Generates the descriptions submitting all the requests to the vLLM scheduler at once.
+
+        Args:
+            images (List[Image.Image]): The sample images.
+            prompts (List[str]): The templated prompts.
+
+        Returns:
+            List[str]: The generated texts.
+        """
+        requests = [
+            {"prompt": prompt, "multi_modal_data": {"image": image}}
+            for image, prompt in zip(images, prompts)
+        ]
+        outputs = self._llm.generate(requests, self._sampling_params)
+        return [output.outputs[0].text for output in outputs]
@@ -10,10 +10,12 @@ from typing import List, Tuple
 from PIL import Image
 import numpy as np
 import torch
+import torch.nn.functional as F
 import clip
 
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
+dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8 else torch.float16
 
 
 
@@ -174,12 +176,16 @@ class CaptionEmbeddingDistance(Metric):
         if topics is None:
             return 0
         
-        result = 0.0
-        with torch.no_grad():
-            E = self._encoder.encode_text(clip.tokenize([c.lower() for c in topics]).to(device))
-        E = E / E.norm(dim=-1, keepdim=True)
-        E = E.cpu().numpy()
-        # Performing cosine distance between embeddings
-        distance = np.sum(pairwise_distances(E, metric="cosine"))
-        result = distance / (len(topics) * (len(topics) - 1))
-        return result
+        n = len(topics)
+        tokens = clip.tokenize([c.lower() for c in topics])
+        if device == "cuda":
+            tokens = tokens.pin_memory()
+        tokens = tokens.to(device, non_blocking=True)
+        with torch.no_grad(), torch.autocast(device_type=device, dtype=dtype, enabled=device == "cuda"):
+            E = self._encoder.encode_text(tokens)
+        E = F.normalize(E.float(), dim=-1)
+        # Performing cosine distance between embeddings, the self-similarities being exactly 1
+        S = E @ E.t()
+        similarity = S.sum() - n
+        result = 1 - similarity / (n * (n - 1))
+        return result.cpu().item()